@@ -0,0 +1,209 @@
+# backup.py
+import os
+import gzip
+import glob
+import time
+import shutil
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+
+import db as db_utils
+import users
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_SLEEP = 0.01  # Seconds between steps, so writers get the lock in between
+BACKUP_MAX_RESTARTS = 5  # Per attempt, for rollback journal databases
+BACKUP_MAX_ATTEMPTS = 5
+BACKUP_BACKOFF = 1  # Seconds before the second attempt, doubled after each one
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def all_databases():
+    """Paths of every database served (one per user in multi-user mode)"""
+    accounts = users.load_users()
+    if not accounts:
+        return [db_utils.DATABASE]
+    return [users.database_path(username) for username in accounts]
+
+
+def backup_database(
+    path,
+    backup_dir=BACKUP_DIR,
+    keep=BACKUP_KEEP,
+    compress=True,
+    pages=BACKUP_PAGES_PER_STEP,
+    sleep=BACKUP_SLEEP,
+    max_restarts=BACKUP_MAX_RESTARTS,
+    max_attempts=BACKUP_MAX_ATTEMPTS,
+    backoff=BACKUP_BACKOFF,
+):
+    """Snapshot a live database with the online backup API and rotate old snapshots.
+
+    Databases in WAL mode (as the app opens them) are copied in a single step
+    from one read snapshot, which doesn't block writers.
+
+    Otherwise the source is only locked while a step of `pages` pages is copied,
+    so the longest step is the longest a writer could have waited on the backup.
+    Every write restarts the copy, so after `max_restarts` the attempt is given
+    up and retried later, backing off exponentially.
+    """
+    assert os.path.exists(path), f"No database at {path}"
+    os.makedirs(backup_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # Microseconds and pid keep concurrent backups from sharing a file
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    snapshot = os.path.join(backup_dir, f"{stem}-{timestamp}-{os.getpid()}.db")
+    partial = snapshot + ".partial"
+
+    stats = {
+        "steps": 0,
+        "restarts": 0,
+        "attempts": 0,
+        "wal": False,
+        "locked_seconds": 0.0,
+        "max_step_seconds": 0.0,
+    }
+    last = {"time": None, "remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        # Called right after each step, before sleeping and releasing to writers
+        step_seconds = time.perf_counter() - last["time"]
+        stats["steps"] += 1
+        stats["locked_seconds"] += step_seconds
+        stats["max_step_seconds"] = max(stats["max_step_seconds"], step_seconds)
+        # No progress: another connection wrote to the source, so SQLite started over
+        if last["remaining"] is not None and remaining >= last["remaining"]:
+            stats["restarts"] += 1
+            last["restarts"] += 1
+            if last["restarts"] > max_restarts:
+                raise _TooManyRestarts()
+        last["remaining"] = remaining
+        time.sleep(sleep)
+        last["time"] = time.perf_counter()
+
+    started = time.perf_counter()
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(partial)
+    try:
+        try:
+            mode = source.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        except sqlite3.OperationalError:
+            mode = None  # Couldn't switch now, e.g. a writer holds the lock
+        stats["wal"] = mode == "wal"
+        if stats["wal"]:
+            pages = -1
+        while True:
+            stats["attempts"] += 1
+            last.update(time=time.perf_counter(), remaining=None, restarts=0)
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except _TooManyRestarts:
+                if stats["attempts"] >= max_attempts:
+                    error = f"kept restarting after {max_attempts} attempts"
+                    break
+                time.sleep(backoff * 2 ** (stats["attempts"] - 1))
+                continue
+            result = target.execute("PRAGMA integrity_check").fetchone()[0]
+            error = None if result == "ok" else f"failed integrity check: {result}"
+            break
+    finally:
+        target.close()
+        source.close()
+
+    if error:
+        os.remove(partial)
+        raise RuntimeError(f"Backup of {path} {error}")
+
+    if compress:
+        snapshot += ".gz"
+        with open(partial, "rb") as src, gzip.open(snapshot, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(partial)
+    else:
+        os.rename(partial, snapshot)
+
+    # Rotate, timestamps in the names sort chronologically
+    snapshots = sorted(glob.glob(os.path.join(backup_dir, f"{stem}-*.db*")))
+    snapshots = [s for s in snapshots if not s.endswith(".partial")]
+    for old in snapshots[:-keep] if keep else []:
+        os.remove(old)
+
+    stats["path"] = snapshot
+    stats["size"] = os.path.getsize(snapshot)
+    stats["duration_seconds"] = time.perf_counter() - started
+    return stats
+
+
+def print_stats(stats):
+    summary = (
+        f"[{datetime.now()}] Backed up to {stats['path']} ({stats['size']} bytes) "
+        f"in {stats['duration_seconds']:.2f}s."
+    )
+    if stats["wal"]:
+        print(f"{summary} Copied from a WAL snapshot, writers weren't blocked")
+        return
+    print(
+        f"{summary} Writers waited at most "
+        f"{stats['max_step_seconds'] * 1000:.1f}ms per step, "
+        f"{stats['locked_seconds'] * 1000:.1f}ms in total over {stats['steps']} steps "
+        f"({stats['restarts']} restarts, {stats['attempts']} attempts)"
+    )
+
+
+def start_backup_thread(interval_hours, **kwargs):
+    """Back up all databases every `interval_hours` in a daemon thread"""
+
+    def run():
+        while True:
+            time.sleep(interval_hours * 3600)
+            for path in all_databases():
+                try:
+                    print_stats(backup_database(path, **kwargs))
+                except Exception as e:
+                    print(f"[{datetime.now()}] Backup of {path} failed: {e}")
+
+    thread = threading.Thread(target=run, name="backup", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Back up highlights databases without blocking the app"
+    )
+    parser.add_argument("--user", help="Only back up this user's database")
+    parser.add_argument(
+        "--backup-dir",
+        default=BACKUP_DIR,
+        help=f"Where to write snapshots (default: {BACKUP_DIR})",
+    )
+    parser.add_argument(
+        "--keep",
+        type=int,
+        default=BACKUP_KEEP,
+        help=f"Snapshots to keep per database, 0 keeps all (default: {BACKUP_KEEP})",
+    )
+    parser.add_argument(
+        "--no-compress", action="store_true", help="Don't gzip the snapshots"
+    )
+    args = parser.parse_args()
+
+    if args.user:
+        assert args.user in users.load_users(), f"Unknown user '{args.user}'"
+    paths = [users.database_path(args.user)] if args.user else all_databases()
+    for path in paths:
+        print_stats(
+            backup_database(
+                path,
+                backup_dir=args.backup_dir,
+                keep=args.keep,
+                compress=not args.no_compress,
+            )
+        )
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import argparse
+
+import db as db_utils
+import users
+
+COLUMNS = [
+    "id",
+    "deleted",
+    "original_book_title",
+    "book_title",
+    "author",
+    "original_text",
+    "highlight_text",
+    "location",
+    "timestamp",
+    "favorite",
+    "note",
+    "color",
+    "last_review",
+    "review_count",
+    "review_today",
+]
+
+
+def split_statements(script):
+    """Statements of an SQL script, so they can run inside one transaction"""
+    statements, current = [], ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current)
+            current = ""
+    return statements
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rewrite the highlights database in compact storage mode"
+    )
+    parser.add_argument(
+        "--schema",
+        default=users.SCHEMA,
+        help="Path to the table definitions (default: tables.sql next to this script)",
+    )
+    parser.add_argument("--user", help="Rewrite this user's database (multi-user mode)")
+    args = parser.parse_args()
+
+    if args.user:
+        assert args.user in users.load_users(), f"Unknown user '{args.user}'"
+        db_utils.use_database(users.database_path(args.user))
+
+    with open(args.schema, "r") as file:
+        schema = split_statements(file.read())
+
+    if input(f"About to rewrite {db_utils.current_database()}. Proceed? (y/n): ") != "y":
+        exit(1)
+
+    size_before = os.path.getsize(db_utils.current_database())
+
+    with db_utils.get_db() as conn:
+        # Old schemas have NOT NULL 'original' columns, so rebuild the table in
+        # one transaction: any failure rolls back to the untouched old table.
+        # Dropping the renamed table's triggers and index lets tables.sql recreate them.
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE highlights RENAME TO highlights_old")
+        for trigger in ["insert", "delete", "update"]:
+            conn.execute(f"DROP TRIGGER IF EXISTS highlights_after_{trigger}")
+        conn.execute("DROP INDEX IF EXISTS highlights_original_hash")
+        for statement in schema:
+            conn.execute(statement)
+
+        rows = conn.execute(
+            "SELECT {} FROM highlights_old".format(", ".join(COLUMNS))
+        ).fetchall()
+
+        compacted = []
+        for row in rows:
+            row = dict(row)
+            original_text = db_utils.get_original_text(row)
+            row["original_text"] = (
+                None
+                if original_text == row["highlight_text"]
+                else db_utils.pack_text(original_text)
+            )
+            row["original_hash"] = db_utils.text_hash(original_text)
+            if row["original_book_title"] == row["book_title"]:
+                row["original_book_title"] = None
+            compacted.append([row[column] for column in COLUMNS + ["original_hash"]])
+
+        conn.executemany(
+            "INSERT INTO highlights ({}) VALUES ({})".format(
+                ", ".join(COLUMNS + ["original_hash"]),
+                ", ".join(["?"] * (len(COLUMNS) + 1)),
+            ),
+            compacted,
+        )
+        conn.execute("DROP TABLE highlights_old")
+
+        # highlight_text stays plain text, so FTS is rebuilt straight from the table
+        conn.execute("INSERT INTO highlights_fts(highlights_fts) VALUES ('rebuild')")
+        conn.commit()
+        conn.execute("VACUUM")
+
+    size_after = os.path.getsize(db_utils.current_database())
+
+    print("\nCompaction summary:")
+    print(f"Highlights rewritten: {len(rows)}")
+    print(f"Size before: {size_before} bytes")
+    print(f"Size after: {size_after} bytes")
+    print(f"Bytes saved: {size_before - size_after}")
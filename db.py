@@ -1,20 +1,162 @@
 # db.py
+import queue
+import hashlib
 import sqlite3
+import itertools
+import threading
+import zlib
+from collections import OrderedDict
 from contextlib import contextmanager
+from contextvars import ContextVar
 
 DATABASE = "main.db"
+MAX_IDLE_CONNECTIONS = 16  # Kept open across databases, least recently used closed first
 DEFAULT_QUOTE_BOOK_TITLE = "Quotes"
+COMPRESS_MIN_LENGTH = 256  # original_text longer than this is stored zlib-compressed
+MAX_PENDING_CHANGES = 100  # Per listener, slower ones get `overflowed` instead
+
+
+_current_database = ContextVar("current_database", default=None)
+_idle_connections = OrderedDict()  # path -> idle connections, least recently used first
+_idle_connections_lock = threading.Lock()
+
+
+def use_database(path):
+    """Route get_db() calls in the current context (e.g. request) to `path`"""
+    _current_database.set(path)
+
+
+def current_database():
+    return _current_database.get() or DATABASE
+
+
+def _close_idle_connections():
+    """Close least recently used idle connections until under MAX_IDLE_CONNECTIONS"""
+    n_idle = sum(len(connections) for connections in _idle_connections.values())
+    while n_idle > MAX_IDLE_CONNECTIONS:
+        path, connections = next(iter(_idle_connections.items()))
+        connections.pop(0).close()
+        n_idle -= 1
+        if not connections:
+            del _idle_connections[path]
 
 
 @contextmanager
 def get_db():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    """Context manager for database connections, reusing idle ones of the same database"""
+    path = current_database()
+    with _idle_connections_lock:
+        connections = _idle_connections.get(path)
+        conn = connections.pop() if connections else None
+
+    if conn is None:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # Persistent, and lets readers (like backup.py) work without blocking writers
+        conn.execute("PRAGMA journal_mode=WAL")
     try:
         yield conn
     finally:
-        conn.close()
+        # Uncommitted changes are discarded, as closing used to do
+        if conn.in_transaction:
+            conn.rollback()
+        with _idle_connections_lock:
+            _idle_connections.setdefault(path, []).append(conn)
+            _idle_connections.move_to_end(path)
+            _close_idle_connections()
+
+
+_listeners = {}  # path -> set of queues, see subscribe()
+_listeners_lock = threading.Lock()
+_change_ids = itertools.count(1)
+
+
+def subscribe():
+    """Queue receiving a change dict for every highlight written to the current database.
+
+    Changes have an `action` ("new", "edit" or "delete"), the updated `highlight`
+    row, the `previous` one for edits and deletes (None for new highlights) and a
+    `rendered` dict that consumers can use to share work. Renaming,
+    re-authoring or deleting a whole book is a single "book" change with the
+    `books` titles involved instead. Once a change couldn't be queued the
+    listener's `overflowed` is set, and consumers should start over.
+    """
+    listener = queue.Queue(maxsize=MAX_PENDING_CHANGES)
+    listener.overflowed = False
+    with _listeners_lock:
+        _listeners.setdefault(current_database(), set()).add(listener)
+    return listener
+
+
+def unsubscribe(listener):
+    with _listeners_lock:
+        for listeners in _listeners.values():
+            listeners.discard(listener)
+
+
+def _send(listeners, change):
+    for listener in listeners:
+        try:
+            listener.put_nowait(change)
+        except queue.Full:
+            listener.overflowed = True
+
+
+def _publish(conn, action, where, params, previous=None):
+    """Send the highlights matching `where` to the listeners of the current database.
+
+    `previous` maps ids to the rows as they were before the write.
+    """
+    with _listeners_lock:
+        listeners = list(_listeners.get(current_database(), []))
+    if not listeners:
+        return
+
+    highlights = conn.execute(f"SELECT * FROM highlights WHERE {where}", params)
+    for highlight in highlights.fetchall():
+        change = {
+            "id": next(_change_ids),
+            "action": action,
+            "highlight": highlight,
+            "previous": (previous or {}).get(highlight["id"]),
+            "rendered": {},
+        }
+        _send(listeners, change)
+
+
+def _publish_book(*books):
+    """Tell the listeners of the current database that whole books changed"""
+    with _listeners_lock:
+        listeners = list(_listeners.get(current_database(), []))
+    change = {"id": next(_change_ids), "action": "book", "books": set(books)}
+    _send(listeners, change)
+
+
+def pack_text(text):
+    """Compress long passages for storage. Short ones are kept as plain text"""
+    if text is None or len(text) < COMPRESS_MIN_LENGTH:
+        return text
+    packed = zlib.compress(text.encode("utf-8"), 9)
+    return packed if len(packed) < len(text.encode("utf-8")) else text
+
+
+def unpack_text(value):
+    """Inverse of `pack_text`"""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def text_hash(text):
+    """Key for finding a passage again, independent of how it's stored"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_original_text(highlight):
+    """Original passage of a highlight (original_text is NULL while unedited)"""
+    if highlight["original_text"] is None:
+        return highlight["highlight_text"]
+    return unpack_text(highlight["original_text"])
 
 
 def get_highlight_by_id(id):
@@ -26,17 +168,33 @@ def get_highlight_by_id(id):
 def get_highlights_for_review():
     """Get highlights due for review today"""
     with get_db() as conn:
-        return conn.execute(
-            """
-            SELECT * FROM highlights
-            WHERE review_today = 1
-            ORDER BY CASE WHEN book_title = ? THEN 0 ELSE 1 END,
-                     review_count ASC,
-                     last_review ASC,
-                     timestamp DESC
-            """,
-            (DEFAULT_QUOTE_BOOK_TITLE,),
+        return fetch_review_deck(conn)
+
+
+def fetch_review_deck(conn):
+    """Highlights flagged with review_today on `conn`, in review order"""
+    return conn.execute(
+        """
+        SELECT * FROM highlights
+        WHERE review_today = 1
+        ORDER BY CASE WHEN book_title = ? THEN 0 ELSE 1 END,
+                 review_count ASC,
+                 last_review ASC,
+                 timestamp DESC
+        """,
+        (DEFAULT_QUOTE_BOOK_TITLE,),
+    ).fetchall()
+
+
+def get_highlights_by_ids(ids):
+    """Get highlights by ID, in the order of `ids`"""
+    with get_db() as conn:
+        highlights = conn.execute(
+            "SELECT * FROM highlights WHERE id IN ({})".format(", ".join(["?"] * len(ids))),
+            list(ids),
         ).fetchall()
+    by_id = {highlight["id"]: highlight for highlight in highlights}
+    return [by_id[id] for id in ids if id in by_id]
 
 
 def get_all_highlights(
@@ -106,8 +264,12 @@ def exists_highlight(text):
     """Check if a passage already exists in the database (non-deleted) using original_text"""
     with get_db() as conn:
         result = conn.execute(
-            "SELECT id FROM highlights WHERE original_text = ? AND deleted = 0 LIMIT 1",
-            (text,),
+            """
+            SELECT id FROM highlights
+            WHERE original_hash = ? AND deleted = 0
+            LIMIT 1
+            """,
+            (text_hash(text),),
         ).fetchone()
         return result is not None
 
@@ -116,7 +278,12 @@ def find_highlight_by_text(text):
     """Return highlight (even if deleted) matching original_text"""
     with get_db() as conn:
         return conn.execute(
-            "SELECT * FROM highlights WHERE original_text = ? LIMIT 1", (text,)
+            """
+            SELECT * FROM highlights
+            WHERE original_hash = ?
+            LIMIT 1
+            """,
+            (text_hash(text),),
         ).fetchone()
 
 
@@ -128,11 +295,34 @@ def update_highlight(highlight_id, field, value):
         assert value in [True, False]
 
     with get_db() as conn:
-        conn.execute(
-            "UPDATE highlights SET {} = ? WHERE id = ?".format(field),
-            (value, highlight_id),
-        )
+        # Kept for listeners, to tell which views the highlight enters or leaves
+        highlight = conn.execute(
+            "SELECT * FROM highlights WHERE id = ?", (highlight_id,)
+        ).fetchone()
+        if field == "highlight_text":
+            # original_text is only stored once the passage diverges from it
+            original_text = get_original_text(highlight) if highlight else None
+            conn.execute(
+                """
+                UPDATE highlights
+                SET highlight_text = ?, original_text = ?, original_hash = ?
+                WHERE id = ?
+                """,
+                (
+                    value,
+                    None if original_text == value else pack_text(original_text),
+                    original_text and text_hash(original_text),
+                    highlight_id,
+                ),
+            )
+        else:
+            conn.execute(
+                "UPDATE highlights SET {} = ? WHERE id = ?".format(field),
+                (value, highlight_id),
+            )
         conn.commit()
+        action = "delete" if field == "deleted" and value else "edit"
+        _publish(conn, action, "id = ?", (highlight_id,), {highlight_id: highlight})
 
 
 def add_highlight(data):
@@ -159,7 +349,7 @@ def add_highlight(data):
                         note = ?,
                         favorite = ?,
                         highlight_text = ?,
-                        original_text = ?,
+                        original_text = NULL,
                         timestamp = CURRENT_TIMESTAMP
                     WHERE id = ?
                     """,
@@ -169,55 +359,70 @@ def add_highlight(data):
                         data.get("note"),
                         bool(data.get("favorite")),
                         highlight_text,
-                        highlight_text,
                         existing_highlight["id"],
                     ),
                 )
                 conn.commit()
+                _publish(conn, "new", "id = ?", (existing_highlight["id"],))
             return
 
         # Already exists and active
         raise AssertionError("Highlight already exists.")
 
-    # Deal with 'original' columns
+    # Deal with 'original' columns. They are NULL while identical to the current ones
     data["book_title"] = current_book_title
-    data["original_book_title"] = data.get("original_book_title") or data["book_title"]
-    data["original_text"] = highlight_text
+    original_book_title = data.get("original_book_title") or current_book_title
+    data["original_book_title"] = (
+        None if original_book_title == current_book_title else original_book_title
+    )
+    original_text = data.get("original_text") or highlight_text
+    data["original_text"] = (
+        None if original_text == highlight_text else pack_text(original_text)
+    )
+    data["original_hash"] = text_hash(original_text)
 
     with get_db() as conn:
-        conn.execute(
+        cursor = conn.execute(
             """
             INSERT INTO highlights ({}) VALUES ({})
         """.format(", ".join(data.keys()), ", ".join(["?"] * len(data))),
             list(data.values()),
         )
         conn.commit()
+        _publish(conn, "new", "id = ?", (cursor.lastrowid,))
 
 
 def rename_book(old_book_str, new_book_str):
     """Rename a book title in the database"""
     old_book_str = book_current_name(old_book_str)
     with get_db() as conn:
-        conn.execute(
+        cursor = conn.execute(
             """
-            UPDATE highlights SET book_title = ? WHERE book_title = ?
+            UPDATE highlights
+            SET original_book_title = NULLIF(COALESCE(original_book_title, book_title), ?),
+                book_title = ?
+            WHERE book_title = ? AND book_title != ?
         """,
-            (new_book_str, old_book_str),
+            (new_book_str, new_book_str, old_book_str, new_book_str),
         )
         conn.commit()
+        if cursor.rowcount:
+            _publish_book(old_book_str, new_book_str)
 
 
 def update_book_author(book_str, new_author):
     """Update the author for all highlights in the given book"""
     book_str = book_current_name(book_str)
     with get_db() as conn:
-        conn.execute(
+        cursor = conn.execute(
             """
-            UPDATE highlights SET author = ? WHERE book_title = ?
+            UPDATE highlights SET author = ? WHERE book_title = ? AND author IS NOT ?
         """,
-            (new_author, book_str),
+            (new_author, book_str, new_author),
         )
         conn.commit()
+        if cursor.rowcount:
+            _publish_book(book_str)
 
 
 def delete_book(book_str):
@@ -226,13 +431,15 @@ def delete_book(book_str):
     print("deleting book")
     print(book_str)
     with get_db() as conn:
-        conn.execute(
+        cursor = conn.execute(
             """
-            UPDATE highlights SET deleted = 1 WHERE book_title = ?
+            UPDATE highlights SET deleted = 1 WHERE book_title = ? AND deleted = 0
         """,
             (book_str,),
         )
         conn.commit()
+        if cursor.rowcount:
+            _publish_book(book_str)
 
 
 def book_current_name(book_str):
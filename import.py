@@ -4,6 +4,7 @@ import argparse
 from datetime import datetime
 
 import db as db_utils
+import users
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -14,8 +15,13 @@ if __name__ == "__main__":
         default="com.flyersoft.moonreaderp",
         help="Path to Moon Reader backup directory (default: com.flyersoft.moonreaderp)",
     )
+    parser.add_argument("--user", help="Import into this user's database (multi-user mode)")
     args = parser.parse_args()
 
+    if args.user:
+        assert args.user in users.load_users(), f"Unknown user '{args.user}'"
+        db_utils.use_database(users.database_path(args.user))
+
     backup_dir = args.backup_dir
 
     # Find main db (mrbooks.db) file path
@@ -43,7 +49,7 @@ if __name__ == "__main__":
 
     print(f"Found {len(notes)} notes")
 
-    if input(f"About to import to {db_utils.DATABASE}. Proceed? (y/n): ") != "y":
+    if input(f"About to import to {db_utils.current_database()}. Proceed? (y/n): ") != "y":
         exit(1)
 
     books = set()
@@ -60,7 +66,6 @@ if __name__ == "__main__":
         data = {
             "original_book_title": book,
             "book_title": book,
-            "original_text": original,
             "highlight_text": original,
             "color": hex_color,
             "timestamp": timestamp,
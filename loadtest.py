@@ -0,0 +1,374 @@
+# loadtest.py
+import os
+import json
+import time
+import random
+import logging
+import sqlite3
+import argparse
+import tempfile
+import threading
+import http.cookiejar
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from db import text_hash
+
+PASSWORD = "loadtest"
+USERNAME = None  # Multi-user apps only, see --user
+MOON_READER_TOKEN = "loadtest-token"
+DEFAULT_MIX = "import=2,index=4,stats=2,search=2"
+MIN_TAIL_SAMPLES = 10  # Samples beyond a percentile needed to compare it to a baseline
+WORDS = (
+    "time memory river light silence reason habit letter garden winter "
+    "friend country language truth mirror power city morning stranger "
+    "question journey fear book history love death freedom night window"
+).split()
+
+
+def passage(rng, n):
+    """Random passage, unique thanks to the trailing counter"""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(15, 90))]
+    return " ".join(words).capitalize() + f". ({n})"
+
+
+def seed_database(path, n_highlights, rng):
+    """Create a scratch database with `n_highlights` highlights over a few dozen books"""
+    with open("tables.sql", "r") as file:
+        schema = file.read()
+    with sqlite3.connect(path) as conn:
+        conn.executescript(schema)
+        conn.executemany(
+            """
+            INSERT INTO highlights
+                (book_title, author, highlight_text, original_hash, favorite, timestamp)
+            VALUES (?, ?, ?, ?, ?, datetime('now', ?))
+            """,
+            [
+                (
+                    f"Book {rng.randint(1, 40)}",
+                    f"Author {rng.randint(1, 20)}",
+                    text,
+                    text_hash(text),
+                    rng.random() < 0.1,
+                    f"-{rng.randint(0, 1000)} days",
+                )
+                for text in (passage(rng, -i) for i in range(n_highlights))
+            ],
+        )
+    conn.close()
+
+
+def start_local_app(database):
+    """Serve main.py on a free local port in a background thread"""
+    os.environ.pop("USERS_FILE", None)  # single-user mode on the scratch database
+    os.environ.pop("BACKUP_INTERVAL_HOURS", None)
+    os.environ["PASSWORD"] = PASSWORD
+    os.environ["MOON_READER_TOKEN"] = MOON_READER_TOKEN
+
+    from flask import got_request_exception
+    from werkzeug.serving import make_server
+
+    import db
+    import main
+
+    db.DATABASE = database
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # 500 pages don't say why, so count the exceptions server side
+    exceptions = Counter()
+    got_request_exception.connect(
+        lambda sender, exception, **extra: exceptions.update([str(exception)]),
+        main.app,
+        weak=False,
+    )
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, exceptions
+
+
+class Client:
+    """One simulated visitor (anonymous, logged in, or the MoonReader app)"""
+
+    def __init__(self, base_url, password=None, username=None):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+        if password:
+            self.login(password, username)
+
+    def login(self, password, username=None):
+        """Log in, failing loudly so searches aren't silently run anonymously"""
+        payload = {"password": password}
+        if username:
+            payload["username"] = username
+        request = urllib.request.Request(
+            self.base_url + "/check_login",
+            data=json.dumps(payload).encode("utf-8"),
+            method="POST",
+            headers={"Content-Type": "application/json"},
+        )
+        with self.opener.open(request, timeout=60) as response:
+            success = json.load(response).get("success")
+        assert success, f"Could not log in to {self.base_url} as {username or 'owner'}"
+
+    def request(self, method, path, payload=None, headers=None):
+        """Returns (status, seconds)"""
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(
+            self.base_url + path, data=data, method=method, headers=headers or {}
+        )
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 0  # Connection failed or timed out
+        return status, time.perf_counter() - started
+
+
+def sync_payload(rng, n):
+    """A Readwise API highlight as sent by MoonReader's sync"""
+    book = rng.randint(1, 40)
+    return {
+        "highlights": [
+            {
+                "text": passage(rng, n),
+                "title": f"Book {book}",
+                "author": f"Author {book % 20 + 1}",
+                "chapter": f"Chapter {rng.randint(1, 30)}",
+                "source_type": "moonreader",
+                "category": "books",
+                "highlighted_at": time.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            }
+        ]
+    }
+
+
+def run(base_url, n_requests, concurrency, mix, seed):
+    """Fire `n_requests` requests drawn from `mix` and collect their latencies"""
+    kinds, weights = zip(*mix.items())
+    rng = random.Random(seed)
+    plan = rng.choices(kinds, weights=weights, k=n_requests)
+
+    anonymous = Client(base_url)
+    logged_in = Client(base_url, password=PASSWORD, username=USERNAME)
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    lock = threading.Lock()
+
+    def send(i, kind):
+        rng = random.Random(seed + i)
+        if kind == "import":
+            status, seconds = anonymous.request(
+                "POST",
+                "/mr-import",
+                sync_payload(rng, f"{seed}-{i}"),
+                headers={"Authorization": f"Token {MOON_READER_TOKEN}"},
+            )
+        elif kind == "index":
+            status, seconds = anonymous.request("GET", "/")
+        elif kind == "stats":
+            status, seconds = anonymous.request("GET", "/stats")
+        elif kind == "search":
+            status, seconds = logged_in.request("GET", f"/?q={rng.choice(WORDS)}")
+        with lock:
+            latencies[kind].append(seconds)
+            statuses[kind][status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(n_requests), plan))
+    elapsed = time.perf_counter() - started
+
+    return summarize(latencies, statuses, elapsed)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted list"""
+    return values[max(int(round(q / 100 * len(values))) - 1, 0)]
+
+
+def summarize(latencies, statuses, elapsed):
+    results = {"elapsed_seconds": elapsed, "endpoints": {}}
+    everything = sorted(sum(latencies.values(), []))
+    for kind, values in list(latencies.items()) + [("all", everything)]:
+        values = sorted(values)
+        codes = statuses[kind] if kind != "all" else sum(statuses.values(), Counter())
+        results["endpoints"][kind] = {
+            "requests": len(values),
+            "throughput": len(values) / elapsed,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "errors": sum(n for code, n in codes.items() if not 200 <= code < 400),
+        }
+    return results
+
+
+def print_results(results, baseline=None):
+    columns = ["requests", "throughput", "p50_ms", "p95_ms", "p99_ms", "errors"]
+    print(f"\nFinished in {results['elapsed_seconds']:.2f}s")
+    print(f"{'endpoint':<10}" + "".join(f"{c:>14}" for c in columns))
+    for kind, row in results["endpoints"].items():
+        print(f"{kind:<10}" + "".join(f"{row[c]:>14.1f}" for c in columns))
+        if baseline and kind in baseline["endpoints"]:
+            old = baseline["endpoints"][kind]
+            print(
+                f"{'  vs base':<10}"
+                + "".join(
+                    f"{(row[c] - old[c]) / old[c] * 100 if old[c] else 0:>+13.1f}%"
+                    for c in columns
+                )
+            )
+
+    if results.get("exceptions"):
+        print("\nServer exceptions:")
+        for message, n in results["exceptions"].items():
+            print(f"{n:>6}  {message}")
+    print(f"\n'database is locked' errors: {results.get('database_locked', 'unknown')}")
+
+
+def regressions(results, baseline, tolerance, min_delta_ms=0, per_endpoint=False):
+    """Metrics that got worse than the baseline by more than `tolerance`.
+
+    Latency and throughput are only checked on the "all" row unless `per_endpoint`,
+    and a percentile only once both runs have MIN_TAIL_SAMPLES beyond it, as
+    anything less is mostly noise. Latencies must also be `min_delta_ms` slower.
+    New errors count on every endpoint.
+    """
+    found = []
+    for kind, row in results["endpoints"].items():
+        old = baseline["endpoints"].get(kind)
+        if not old:
+            continue
+        if row["errors"] > old["errors"]:
+            found.append(f"{kind} errors")
+        if kind != "all" and not per_endpoint:
+            continue
+        for q in [50, 95, 99]:
+            n = min(row["requests"], old["requests"])
+            if n * (100 - q) / 100 < MIN_TAIL_SAMPLES:
+                continue
+            new, base = row[f"p{q}_ms"], old[f"p{q}_ms"]
+            if new > base * (1 + tolerance) and new - base > min_delta_ms:
+                found.append(f"{kind} p{q}_ms")
+        if row["throughput"] < old["throughput"] * (1 - tolerance):
+            found.append(f"{kind} throughput")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay MoonReader sync and browsing traffic against the app"
+    )
+    parser.add_argument(
+        "--url",
+        help="Test a running app instead of a local one on a scratch database "
+        "(set LOADTEST_PASSWORD and LOADTEST_TOKEN for it)",
+    )
+    parser.add_argument(
+        "--user",
+        default=os.environ.get("LOADTEST_USER"),
+        help="Log in as this user, for --url apps in multi-user mode "
+        "(default: LOADTEST_USER)",
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"Relative weights of the request kinds (default: {DEFAULT_MIX})",
+    )
+    parser.add_argument(
+        "--seed-highlights",
+        type=int,
+        default=2000,
+        help="Highlights in the scratch database (default: 2000)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against results saved with --save")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative slowdown vs the baseline (default: 0.25)",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=20,
+        help="Latencies must also be this much slower to regress (default: 20)",
+    )
+    parser.add_argument(
+        "--per-endpoint",
+        action="store_true",
+        help="Also fail on latency/throughput regressions of single endpoints, "
+        "not only of all requests together",
+    )
+    args = parser.parse_args()
+
+    mix = {
+        kind: float(weight)
+        for kind, weight in (item.split("=") for item in args.mix.split(","))
+    }
+    assert set(mix) <= {"import", "index", "stats", "search"}, f"Bad mix {args.mix}"
+    assert args.requests > 0, "--requests must be positive"
+    assert args.concurrency > 0, "--concurrency must be positive"
+    assert not args.user or args.url, "--user only applies to --url apps"
+
+    exceptions = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        PASSWORD = os.environ.get("LOADTEST_PASSWORD", PASSWORD)
+        MOON_READER_TOKEN = os.environ.get("LOADTEST_TOKEN", MOON_READER_TOKEN)
+        USERNAME = args.user
+    else:
+        scratch = tempfile.mkdtemp(prefix="moonwise-loadtest-")
+        database = os.path.join(scratch, "main.db")
+        print(f"Seeding {args.seed_highlights} highlights in {database}...")
+        seed_database(database, args.seed_highlights, random.Random(args.seed))
+        server, exceptions = start_local_app(database)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(
+        f"Sending {args.requests} requests to {base_url} "
+        f"with concurrency {args.concurrency} ({args.mix})..."
+    )
+    results = run(base_url, args.requests, args.concurrency, mix, args.seed)
+    results["config"] = vars(args)
+    if exceptions is not None:
+        results["exceptions"] = dict(exceptions)
+        results["database_locked"] = sum(
+            n for message, n in exceptions.items() if "database is locked" in message
+        )
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved results to {args.save}")
+
+    if baseline:
+        worse = regressions(
+            results, baseline, args.tolerance, args.min_delta_ms, args.per_endpoint
+        )
+        if worse:
+            print(f"Regressions vs baseline: {', '.join(worse)}")
+            exit(1)
+        print("No regressions vs baseline")
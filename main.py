@@ -1,6 +1,9 @@
 import os
+import queue
 from flask import (
     Flask,
+    Response,
+    stream_with_context,
     render_template,
     render_template_string,
     request,
@@ -11,17 +14,29 @@ from flask import (
     jsonify,
 )
 from flask import g  # global session-level object
-from datetime import datetime
+from datetime import datetime, timezone
 from types import SimpleNamespace
 import db
+import users
+import backup
+from review import load_snapshot
 
 N_INDEX_LIMIT = 100
 N_RECENT_IN_STATS = 10
+SSE_KEEPALIVE_SECONDS = 15
+BACKUP_INTERVAL_HOURS = float(os.environ.get("BACKUP_INTERVAL_HOURS", 0))
 
-# REQUIRED ENV VARS
+# REQUIRED ENV VARS (PASSWORD and MOON_READER_TOKEN only in single-user mode)
 SESSION_SECRET = os.environ.get("SESSION_SECRET", "devkey")
-MOON_READER_TOKEN = os.environ.get("SESSION_SECRET", "token not set")
-PASSWORD = os.environ["PASSWORD"]
+MOON_READER_TOKEN = os.environ.get("MOON_READER_TOKEN")
+PASSWORD = os.environ.get("PASSWORD")
+
+# Multi-user mode: one database per account listed in USERS_FILE
+USERS = users.load_users()
+PUBLIC_USER = os.environ.get("PUBLIC_USER") or next(iter(USERS), None)
+assert USERS or PASSWORD, "Set PASSWORD, or USERS_FILE for multi-user mode"
+assert not USERS or PUBLIC_USER in USERS, f"Unknown PUBLIC_USER '{PUBLIC_USER}'"
+users.create_missing_databases(USERS)
 
 PUBLIC_ROUTES = [
     "check_login",
@@ -31,29 +46,50 @@ PUBLIC_ROUTES = [
     "stats",
     "static",
     "mr_import",
+    "changes",
 ]
 assert "check_login" in PUBLIC_ROUTES
 
 app = Flask(__name__)
 app.secret_key = SESSION_SECRET
+app.config["MULTI_USER"] = bool(USERS)
 if app.secret_key == "devkey":
     print("WARNING: no secret key found, using default devkey")
 
 
+@app.before_request
+def route_database():
+    """Serve the logged in user's database, or the public one to visitors"""
+    if USERS:
+        username = session.get("user")
+        g.user = username if username in USERS else None
+        db.use_database(users.database_path(g.user or PUBLIC_USER))
+
+
 @app.before_request
 def check_if_logged():
     g.logged_in = session.get("logged_in", False)
+    if USERS and g.user is None:
+        g.logged_in = False
 
 
 @app.before_request
 def require_auth():
-    if request.endpoint not in PUBLIC_ROUTES and not session.get("logged_in"):
+    if request.endpoint not in PUBLIC_ROUTES and not g.logged_in:
         return render_template("_login_modal.html")
 
 
 @app.route("/check_login", methods=["POST"])
 def check_login():
-    if request.json.get("password") == PASSWORD:
+    if USERS:
+        username = request.json.get("username")
+        user = USERS.get(username) if isinstance(username, str) else None
+        password = user and user["password"]
+    else:
+        username, password = None, PASSWORD
+
+    if password and request.json.get("password") == password:
+        session["user"] = username
         session["logged_in"] = True
         session.permanent = True
         return jsonify(success=True)
@@ -62,7 +98,7 @@ def check_login():
 
 @app.route("/login")
 def login():
-    if session.get("logged_in"):
+    if g.logged_in:
         return redirect(url_for("index"))
     return render_template(
         "_login_modal.html",
@@ -72,6 +108,7 @@ def login():
 @app.route("/logout")
 def logout():
     session.pop("logged_in", None)
+    session.pop("user", None)
     return redirect(url_for("index"))
 
 
@@ -112,11 +149,145 @@ def index():
     )
 
 
+def is_visible(highlight, book_filter, favorites_only, show_all_actions):
+    """Whether index.html with these filters shows `highlight`"""
+    return bool(
+        (not book_filter or highlight["book_title"] == book_filter)
+        and (not favorites_only or highlight["favorite"])
+        and (show_all_actions or not highlight["deleted"])
+    )
+
+
+def render_change(change, book_filter, favorites_only, show_all_actions):
+    """Out-of-band swaps applying a change to index.html, shared by similar viewers"""
+    highlight = change["highlight"]
+    visible = is_visible(highlight, book_filter, favorites_only, show_all_actions)
+    key = (visible, show_all_actions)
+    if key not in change["rendered"]:
+        change["rendered"][key] = render_template_string(
+            """
+            {% from "_highlight_card.html" import highlight_card %}
+            {% if not visible or action == "new" %}
+            <div id="highlight-{{ highlight.id }}" hx-swap-oob="delete"></div>
+            {% endif %}
+            {% if visible and action == "new" %}
+            <div hx-swap-oob="afterbegin:#highlights">
+                {{ highlight_card(highlight, show_all_actions=show_all_actions) }}
+            </div>
+            {% elif visible %}
+            {{ highlight_card(highlight, show_all_actions=show_all_actions, oob=True) }}
+            {% endif %}
+            """,
+            highlight=highlight,
+            action=change["action"],
+            visible=visible,
+            show_all_actions=show_all_actions,
+        )
+    return change["rendered"][key]
+
+
+@app.route("/changes")
+def changes():
+    """Server-sent events with cards of highlights added, edited or deleted since connecting.
+
+    "reload" events ask the page to refetch its highlights: after changes to whole
+    books, edits bringing a highlight into view (its card isn't on the page to be
+    replaced, and its place in the list is unknown), or when this client fell too
+    far behind.
+    """
+    book_filter = request.args.get("book")
+    favorites_only = request.args.get("favorites") == "1"
+    if not g.logged_in:
+        favorites_only = 1
+        book_filter = ""
+    show_all_actions = g.logged_in
+
+    listener = db.subscribe()
+
+    @stream_with_context
+    def stream():
+        try:
+            while True:
+                try:
+                    change = listener.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if listener.overflowed:
+                    # Changes were dropped, the page refetches all of them instead
+                    while not listener.empty():
+                        listener.get_nowait()
+                    listener.overflowed = False
+                    yield "event: reload\ndata: reload\n\n"
+                    continue
+                if change["action"] == "book":
+                    if not book_filter or book_filter in change["books"]:
+                        yield f"id: {change['id']}\nevent: reload\ndata: reload\n\n"
+                    continue
+                filters = (book_filter, favorites_only, show_all_actions)
+                previous = change["previous"]
+                if (
+                    previous
+                    and not is_visible(previous, *filters)
+                    and is_visible(change["highlight"], *filters)
+                ):
+                    yield f"id: {change['id']}\nevent: reload\ndata: reload\n\n"
+                    continue
+                fragment = render_change(
+                    change, book_filter, favorites_only, show_all_actions
+                )
+                data = "".join(
+                    f"data: {line}\n" for line in fragment.splitlines() if line.strip()
+                )
+                yield f"id: {change['id']}\n{data}\n"
+        finally:
+            db.unsubscribe(listener)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/review")
 def review():
     """Page showing today's highlights to review"""
-    highlights = db.get_highlights_for_review()
-    return render_template("review.html", highlights=highlights)
+    snapshot = load_snapshot()
+    if snapshot and snapshot["decks"]:
+        highlights = db.get_highlights_by_ids(snapshot["decks"][0]["ids"])
+    else:
+        highlights = db.get_highlights_for_review()
+    return render_template(
+        "review.html",
+        highlights=highlights,
+        decks_etag=snapshot["etag"] if snapshot else None,
+    )
+
+
+@app.route("/review/decks")
+def review_decks():
+    """Today's and upcoming review decks as JSON, cacheable until the next review.py run.
+
+    Only cached as immutable under a URL naming its ETag (`v`, as review.html links
+    it), so users sharing a browser never get each other's decks from the cache.
+    """
+    snapshot = load_snapshot()
+    if snapshot is None:
+        return "", 404
+
+    response = app.response_class(snapshot["raw"], mimetype="application/json")
+    response.set_etag(snapshot["etag"])
+    response.cache_control.private = True
+    expires_at = datetime.fromisoformat(snapshot["expires_at"])
+    max_age = int((expires_at - datetime.now(timezone.utc)).total_seconds())
+    if max_age > 0 and request.args.get("v") == snapshot["etag"]:
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = True
+        response.expires = expires_at
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route("/add", methods=["GET", "POST"])
@@ -244,7 +415,13 @@ def mr_import():
     """Import highlights from MoonReader with 'Readwise sync' function"""
 
     token = request.headers.get("Authorization", "Token").split("Token")[1].strip()
-    if token != os.environ.get("MOON_READER_TOKEN"):
+    if USERS:
+        username = users.user_for_token(USERS, token)
+        if username is None:
+            print("Token does not match any user")
+            return "", 500
+        db.use_database(users.database_path(username))
+    elif token != MOON_READER_TOKEN:
         print("Token does not match")
         return "", 500
 
@@ -271,4 +448,8 @@ def str_to_date(value, format="%B, %Y"):
 
 
 if __name__ == "__main__":
+    # Only in the reloader's child, the process actually serving. Servers with
+    # several processes (gunicorn...) should run backup.py from cron instead
+    if BACKUP_INTERVAL_HOURS and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        backup.start_backup_thread(BACKUP_INTERVAL_HOURS)
     app.run(debug=True, port=5002)
@@ -1,79 +1,204 @@
 import os
-from datetime import datetime
-from db import get_db, DEFAULT_QUOTE_BOOK_TITLE
+import json
+import hashlib
+import argparse
+from datetime import datetime, timedelta, timezone
 
-if __name__ == "__main__":
-    N_REVIEW_PASSAGES = int(os.environ.get("N_REVIEW_PASSAGES", 5))
-    N_FAVORITES_IN_REVIEW = int(os.environ.get("N_FAVORITES_IN_REVIEW", 1))
+import users
+from db import (
+    get_db,
+    use_database,
+    current_database,
+    fetch_review_deck,
+    DEFAULT_QUOTE_BOOK_TITLE,
+)
+
+REVIEW_SNAPSHOT_DIR = os.environ.get("REVIEW_SNAPSHOT_DIR", "decks")
+REVIEW_INTERVAL_HOURS = float(os.environ.get("REVIEW_INTERVAL_HOURS", 24))
+SNAPSHOT_COLUMNS = [
+    "id",
+    "book_title",
+    "author",
+    "highlight_text",
+    "note",
+    "location",
+    "timestamp",
+    "favorite",
+    "color",
+    "review_count",
+    "last_review",
+]
+
+_snapshots = {}  # path -> (mtime, snapshot), see load_snapshot()
+
+
+def snapshot_path(database=None):
+    """Where review.py writes the decks of `database` (default: the current one)"""
+    stem = os.path.splitext(os.path.basename(database or current_database()))[0]
+    return os.path.join(REVIEW_SNAPSHOT_DIR, f"{stem}.json")
+
+
+def load_snapshot(database=None):
+    """Decks written by the last review.py run (plus its raw JSON and ETag), or None"""
+    path = snapshot_path(database)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if path not in _snapshots or _snapshots[path][0] != mtime:
+        with open(path, "rb") as file:
+            raw = file.read()
+        etag = hashlib.sha1(raw).hexdigest()
+        _snapshots[path] = (mtime, {"raw": raw, "etag": etag, **json.loads(raw)})
+    return _snapshots[path][1]
 
-    print(f"[{datetime.now()}] Running daily review update...")
 
+def select_deck(conn, n_review_passages, n_favorites_in_review, day):
     """Select highlights for review, prioritizing less-reviewed and older ones."""
-    with get_db() as conn:
-        # Reset all review_today flags
-        conn.execute("""UPDATE highlights SET review_today = 0""")
-        conn.commit()
+    # Reset all review_today flags
+    conn.execute("""UPDATE highlights SET review_today = 0""")
+
+    # Always pull one quote if available
+    quote_row = conn.execute(
+        """
+        SELECT id FROM highlights
+        WHERE deleted = 0 AND book_title = ?
+        ORDER BY review_count ASC, last_review ASC, RANDOM()
+        LIMIT 1
+        """,
+        (DEFAULT_QUOTE_BOOK_TITLE,),
+    ).fetchone()
 
-        # Always pull one quote if available
-        quote_row = conn.execute(
+    selected_quote = False
+    if quote_row:
+        selected_quote = True
+        conn.execute(
             """
-            SELECT id FROM highlights
-            WHERE deleted = 0 AND book_title = ?
-            ORDER BY review_count ASC, last_review ASC, RANDOM()
-            LIMIT 1
+            UPDATE highlights
+            SET review_today = 1, review_count = review_count + 1, last_review = ?
+            WHERE id = ?
             """,
-            (DEFAULT_QUOTE_BOOK_TITLE,),
-        ).fetchone()
-
-        selected_quote = False
-        if quote_row:
-            selected_quote = True
-            conn.execute(
-                """
-                UPDATE highlights
-                SET review_today = 1, review_count = review_count + 1, last_review = date('now')
-                WHERE id = ?
-                """,
-                (quote_row["id"],),
+            (day, quote_row["id"]),
+        )
+
+    remaining_slots = max(n_review_passages - (1 if selected_quote else 0), 0)
+    favorite_limit = min(n_favorites_in_review, remaining_slots)
+    general_limit = max(remaining_slots - favorite_limit, 0)
+
+    # Select favorite highlights for review
+    if favorite_limit:
+        conn.execute(
+            """
+            UPDATE highlights
+            SET review_today = 1, review_count = review_count + 1, last_review = ?
+            WHERE id IN (
+                SELECT id FROM highlights
+                WHERE deleted = 0 AND favorite = 1 AND review_today = 0 AND book_title != ?
+                ORDER BY review_count ASC, last_review ASC, RANDOM()
+                LIMIT ?
             )
-            conn.commit()
-
-        remaining_slots = max(N_REVIEW_PASSAGES - (1 if selected_quote else 0), 0)
-        favorite_limit = min(N_FAVORITES_IN_REVIEW, remaining_slots)
-        general_limit = max(remaining_slots - favorite_limit, 0)
-
-        # Select favorite highlights for review
-        if favorite_limit:
-            conn.execute(
-                """
-                UPDATE highlights
-                SET review_today = 1, review_count = review_count + 1, last_review = date('now')
-                WHERE id IN (
-                    SELECT id FROM highlights
-                    WHERE deleted = 0 AND favorite = 1 AND review_today = 0 AND book_title != ?
-                    ORDER BY review_count ASC, last_review ASC, RANDOM()
-                    LIMIT ?
-                )
-            """,
-                (DEFAULT_QUOTE_BOOK_TITLE, favorite_limit),
+        """,
+            (day, DEFAULT_QUOTE_BOOK_TITLE, favorite_limit),
+        )
+
+    # Select general highlights for review
+    if general_limit:
+        conn.execute(
+            """
+            UPDATE highlights
+            SET review_today = 1, review_count = review_count + 1, last_review = ?
+            WHERE id IN (
+                SELECT id FROM highlights
+                WHERE deleted = 0 AND review_today = 0 AND book_title != ?
+                ORDER BY review_count ASC, last_review ASC, RANDOM()
+                LIMIT ?
             )
-            conn.commit()
-
-        # Select general highlights for review
-        if general_limit:
-            conn.execute(
-                """
-                UPDATE highlights
-                SET review_today = 1, review_count = review_count + 1, last_review = date('now')
-                WHERE id IN (
-                    SELECT id FROM highlights
-                    WHERE deleted = 0 AND review_today = 0 AND book_title != ?
-                    ORDER BY review_count ASC, last_review ASC, RANDOM()
-                    LIMIT ?
-                )
-            """,
-                (DEFAULT_QUOTE_BOOK_TITLE, general_limit),
+        """,
+            (day, DEFAULT_QUOTE_BOOK_TITLE, general_limit),
+        )
+
+
+def apply_deck(conn, ids, day):
+    """Flag an already planned deck for review, skipping since deleted highlights"""
+    conn.execute("""UPDATE highlights SET review_today = 0""")
+    conn.execute(
+        """
+        UPDATE highlights
+        SET review_today = 1, review_count = review_count + 1, last_review = ?
+        WHERE deleted = 0 AND id IN ({})
+        """.format(", ".join(["?"] * len(ids))),
+        [day, *ids],
+    )
+
+
+def schedule_review(n_review_passages, n_favorites_in_review, n_days=1):
+    """Flag today's deck and write a snapshot with it and the next `n_days - 1` decks.
+
+    Decks planned by earlier runs are kept, so prefetched ones stay valid. Later
+    days are simulated on top of today's and rolled back.
+    """
+    now = datetime.now(timezone.utc)
+    snapshot = load_snapshot() or {"decks": []}
+    planned = {deck["date"]: deck["ids"] for deck in snapshot["decks"]}
+
+    decks = []
+    with get_db() as conn:
+        for i in range(n_days):
+            day = (now + timedelta(days=i)).date().isoformat()
+            if planned.get(day):
+                apply_deck(conn, planned[day], day)
+            else:
+                select_deck(conn, n_review_passages, n_favorites_in_review, day)
+
+            highlights = [
+                {column: highlight[column] for column in SNAPSHOT_COLUMNS}
+                for highlight in fetch_review_deck(conn)
+            ]
+            decks.append(
+                {
+                    "date": day,
+                    "ids": [highlight["id"] for highlight in highlights],
+                    "highlights": highlights,
+                }
             )
-            conn.commit()
+            if i == 0:
+                conn.commit()
+        conn.rollback()
+
+    snapshot = {
+        "generated_at": now.isoformat(),
+        "expires_at": (now + timedelta(hours=REVIEW_INTERVAL_HOURS)).isoformat(),
+        "decks": decks,
+    }
+    path = snapshot_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".partial", "w") as file:
+        json.dump(snapshot, file)
+    os.replace(path + ".partial", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select today's review highlights")
+    parser.add_argument(
+        "--user",
+        help="Only update this user's database (multi-user mode, default: all users)",
+    )
+    args = parser.parse_args()
+
+    N_REVIEW_PASSAGES = int(os.environ.get("N_REVIEW_PASSAGES", 5))
+    N_FAVORITES_IN_REVIEW = int(os.environ.get("N_FAVORITES_IN_REVIEW", 1))
+    N_REVIEW_DAYS_AHEAD = int(os.environ.get("N_REVIEW_DAYS_AHEAD", 7))
+
+    print(f"[{datetime.now()}] Running daily review update...")
+
+    accounts = users.load_users()
+    users.create_missing_databases(accounts)
+    if not accounts:
+        schedule_review(N_REVIEW_PASSAGES, N_FAVORITES_IN_REVIEW, N_REVIEW_DAYS_AHEAD)
+    for username in [args.user] if args.user else accounts:
+        assert username in accounts, f"Unknown user '{username}'"
+        print(f"[{datetime.now()}] Updating review for {username}")
+        use_database(users.database_path(username))
+        schedule_review(N_REVIEW_PASSAGES, N_FAVORITES_IN_REVIEW, N_REVIEW_DAYS_AHEAD)
 
     print(f"[{datetime.now()}] Review schedule updated.")
@@ -3,10 +3,11 @@
 CREATE TABLE IF NOT EXISTS highlights (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     deleted BOOLEAN DEFAULT 0,
-    original_book_title TEXT NOT NULL,
+    original_book_title TEXT,  -- NULL while equal to book_title
     book_title TEXT NOT NULL,
     author TEXT,
-    original_text TEXT NOT NULL,
+    original_text TEXT,  -- NULL while equal to highlight_text, zlib BLOB if long
+    original_hash TEXT,  -- sha1 of the original passage, to find duplicates
     highlight_text TEXT NOT NULL,
     location TEXT,  -- Could be a page number or other reference
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,  -- When it was added
@@ -19,6 +20,8 @@ CREATE TABLE IF NOT EXISTS highlights (
     review_today BOOLEAN DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS highlights_original_hash ON highlights(original_hash);
+
 -- FTS table for full-text search
 CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(
     highlight_text,
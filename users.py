@@ -0,0 +1,53 @@
+# users.py
+import os
+import json
+import sqlite3
+
+USERS_FILE = os.environ.get("USERS_FILE")
+DATABASE_DIR = os.environ.get("DATABASE_DIR", "dbs")
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tables.sql")
+
+
+def load_users(path=USERS_FILE):
+    """Accounts as {username: {"password": ..., "token": ...}}. Empty in single-user mode"""
+    if not path:
+        return {}
+    with open(path, "r") as file:
+        users = json.load(file)
+
+    for username, user in users.items():
+        assert username.isidentifier(), f"Invalid username '{username}'"
+        assert user.get("password") and user.get("token"), (
+            f"User '{username}' needs a password and a token"
+        )
+    tokens = [user["token"] for user in users.values()]
+    assert len(set(tokens)) == len(tokens), "MoonReader tokens must be unique"
+    return users
+
+
+def database_path(username):
+    """Path of the database holding `username`'s highlights"""
+    return os.path.join(DATABASE_DIR, f"{username}.db")
+
+
+def user_for_token(users, token):
+    """Username owning a MoonReader sync token, or None"""
+    return next(
+        (username for username, user in users.items() if user["token"] == token),
+        None,
+    )
+
+
+def create_missing_databases(users):
+    """Create (with tables.sql) the databases of users that don't have one yet"""
+    if not users:
+        return
+    os.makedirs(DATABASE_DIR, exist_ok=True)
+    for username in users:
+        path = database_path(username)
+        if os.path.exists(path):
+            continue
+        print(f"Creating database for {username} at {path}")
+        with sqlite3.connect(path) as conn, open(SCHEMA, "r") as file:
+            conn.executescript(file.read())
+        conn.close()